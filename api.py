@@ -1,16 +1,20 @@
 import asyncio
 import json
 import base64
+import gzip
 import hashlib
-from datetime import datetime, timedelta
+import heapq
 import os
+import sys
+import time
 from typing import Dict, Optional
 import asyncpg
+import orjson
 from fastapi import FastAPI, Request, HTTPException, Query
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from pathlib import Path
 
 # ---------------------------------------------------
@@ -18,68 +22,671 @@ from pathlib import Path
 # ---------------------------------------------------
 load_dotenv()
 DB_URL = os.getenv("DATABASE_URL")
+# LISTEN and schema DDL need a real session, which a transaction-mode pooler
+# (e.g. Neon's -pooler host) does not provide; point this at the direct host
+DB_URL_DIRECT = os.getenv("DATABASE_URL_DIRECT") or DB_URL
+
+# Pool sizing: each uvicorn worker holds up to DB_POOL_MAX pool connections
+# plus one LISTEN connection, so (DB_POOL_MAX + 1) x workers must stay below
+# the server's max_connections (Postgres default 100, minus reserved slots).
+# The defaults leave room for 2 workers. For larger fleets put pgbouncer in
+# transaction mode in front; it needs max_prepared_statements > 0 (1.21+)
+# because the hot statements are prepared on every connection.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 5))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 30))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 1024))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 10))
 
 BASE_DIR = Path(__file__).parent
 PUBLIC_KEY_PATH = BASE_DIR / "public.pem"
 
 VERSION_FALLBACK = "0.0.0"  # used if DB empty
 
+PUBLIC_KEY_PEM = """-----BEGIN PUBLIC KEY-----
+MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA8sPfrF4g6PreceYsXlFm
+8EfXnbrVw357XIONBw944ltP708tnM4bRUBHlVoKdHigmoTjWgiz3IsKozOWsydp
+qcQWB/ooQKqi4/Quvy1H5f2MFdlLZnyFPZOsW4Cq6X7ngtyxM0+WpDkU4EMBgwuL
+Zwvqx1UYeh0prRqEsR4x766NjYDklaSf6Xbj4GQRrYkWRi3Up47cRD3GIH33AhbJ
+AwlxqefLHeicMAT5s+povQGjnLizKqNgLFjIzaMfKbAifQ6jfvq/pG7WWcUSkZ4c
+p1IdGVbcH50OtxwKervSH1QDhF4Es2O9gHK/+admpSTko7fK7wHc5fk/anH2Hzzl
+nwIDAQAB
+-----END PUBLIC KEY-----"""
+
+# the key never changes, so its response body and validators are built once
+_PK_BYTES = orjson.dumps({"public_key": PUBLIC_KEY_PEM})
+_PK_ETAG = '"%s"' % hashlib.sha256(_PK_BYTES).hexdigest()
+_PK_HEADERS = {
+    "Cache-Control": "public, max-age=31536000, immutable",
+    "ETag": _PK_ETAG,
+}
+
+# node columns register diffs into node_change_log (must match prev and the
+# old_<field> columns in REGISTER_UPSERT_SQL)
+NODE_SPEC_FIELDS = [
+    "hostname", "ip_address", "mac_address", "os",
+    "cpu_model", "cpu_cores", "memory_gb", "storage_gb",
+    "drives", "gpu_model", "version"
+]
+
+HB_BATCH_WINDOW = 0.1  # seconds to coalesce heartbeats before one flush
+HB_BATCH_MAX = 1000    # max queued heartbeats written per flush
+HB_FLUSH_INTERVAL = 30  # seconds a recently seen node may skip the DB write
+_HB_OK_PREFIX = b'{"status":"updated","id":'
+
+OFFLINE_AFTER = 300           # seconds without a heartbeat; passed to OFFLINE_*_SQL
+OFFLINE_SWEEP_INTERVAL = OFFLINE_AFTER  # full-table fallback for nodes this process never saw
+OFFLINE_RETRY_INTERVAL = 15   # retry delay for heap candidates after a failed mark
+
+PAYLOAD_CHANNEL = "payloads_changed"
+PAYLOAD_REFRESH_INTERVAL = 60  # re-read payloads even without a NOTIFY
+
+
+# ---------------------------------------------------
+# SQL
+# ---------------------------------------------------
+# one round-trip (and one transaction) for a whole batch: the update and
+# the log of its status transitions commit or fail together
+HEARTBEAT_BATCH_SQL = """
+    WITH prev AS (
+        SELECT id, status
+        FROM nodes
+        WHERE id = ANY($1)
+        ORDER BY id
+        FOR UPDATE
+    ),
+    upd AS (
+        UPDATE nodes
+        SET last_heartbeat = now(),
+            status = 'online'
+        FROM prev
+        WHERE nodes.id = prev.id
+        RETURNING nodes.id, prev.status AS old_status
+    ),
+    log AS (
+        INSERT INTO node_change_log (node_id, field_name, old_value, new_value, changed_at)
+        SELECT id, 'status', old_status, 'online', now()
+        FROM upd
+        WHERE old_status IS DISTINCT FROM 'online'
+    )
+    SELECT id
+    FROM upd
+"""
+
+LOG_CHANGE_SQL = """
+    INSERT INTO node_change_log (node_id, field_name, old_value, new_value, changed_at)
+    VALUES ($1, $2, $3, $4, now())
+"""
+
+# several fields of one node in one round-trip, stamped with the DB clock
+# like every other change-log row
+LOG_CHANGES_SQL = """
+    INSERT INTO node_change_log (node_id, field_name, old_value, new_value, changed_at)
+    SELECT $1, unnest($2::text[]), unnest($3::text[]), unnest($4::text[]), now()
+"""
+
+# mark every stale node offline and log the transitions in one statement;
+# SKIP LOCKED lets concurrent scanners (one per worker) share the work
+OFFLINE_SWEEP_SQL = """
+    WITH stale AS (
+        SELECT id, status
+        FROM nodes
+        WHERE last_heartbeat < (now() - make_interval(secs => $1))
+          AND status != 'offline'
+        FOR UPDATE SKIP LOCKED
+    ),
+    upd AS (
+        UPDATE nodes
+        SET status='offline',
+            last_checked=now()
+        FROM stale
+        WHERE nodes.id = stale.id
+        RETURNING nodes.id, stale.status AS old_status
+    )
+    INSERT INTO node_change_log (node_id, field_name, old_value, new_value, changed_at)
+    SELECT id, 'status', old_status, 'offline', now()
+    FROM upd
+"""
+
+# same as OFFLINE_SWEEP_SQL, limited to the ids whose in-process deadline
+# passed; the DB check keeps a heartbeat seen by another worker from losing.
+# Candidates left online come back with the seconds until the DB considers
+# them stale (last_heartbeat is written after the request was seen here),
+# so the scanner can recheck them then instead of dropping them.
+OFFLINE_MARK_SQL = """
+    WITH stale AS (
+        SELECT id, status
+        FROM nodes
+        WHERE id = ANY($1)
+          AND last_heartbeat < (now() - make_interval(secs => $2))
+          AND status != 'offline'
+        FOR UPDATE SKIP LOCKED
+    ),
+    upd AS (
+        UPDATE nodes
+        SET status='offline',
+            last_checked=now()
+        FROM stale
+        WHERE nodes.id = stale.id
+        RETURNING nodes.id, stale.status AS old_status
+    ),
+    log AS (
+        INSERT INTO node_change_log (node_id, field_name, old_value, new_value, changed_at)
+        SELECT id, 'status', old_status, 'offline', now()
+        FROM upd
+    )
+    SELECT id,
+           EXTRACT(EPOCH FROM last_heartbeat + make_interval(secs => $2) - now())::float8 AS remaining
+    FROM nodes
+    WHERE id = ANY($1)
+      AND status != 'offline'
+      AND last_heartbeat IS NOT NULL
+      AND id NOT IN (SELECT id FROM upd)
+"""
+
+# prev reads the existing row from the statement's snapshot, i.e. as it was
+# before the upsert, so register can diff old vs new without an extra
+# round-trip; both sides come back as typed columns (old_<field>) so the log
+# keeps asyncpg's value formatting. No FOR UPDATE here: prev is only read by
+# the RETURNING subqueries, so it would run after the upsert and skip the row
+# it just modified (leaving prev empty); ON CONFLICT DO UPDATE locks the row
+REGISTER_UPSERT_SQL = """
+    WITH prev AS (
+        SELECT hostname, ip_address, mac_address, os,
+               cpu_model, cpu_cores, memory_gb, storage_gb,
+               drives, gpu_model, version
+        FROM nodes
+        WHERE id = $1
+    )
+    INSERT INTO nodes (
+        id, hostname, ip_address, mac_address, os,
+        cpu_model, cpu_cores, memory_gb, storage_gb, drives,
+        gpu_model, version, location, owner, notes,
+        status, last_heartbeat, last_checked
+    )
+    VALUES (
+        $1, $2, $3, $4, $5,
+        $6, $7, $8, $9, $10,
+        $11, $12, '', '', '',
+        'offline', NULL, NULL
+    )
+    ON CONFLICT (id)
+    DO UPDATE SET
+        hostname      = COALESCE(EXCLUDED.hostname, nodes.hostname),
+        ip_address    = COALESCE(EXCLUDED.ip_address, nodes.ip_address),
+        mac_address   = COALESCE(EXCLUDED.mac_address, nodes.mac_address),
+        os            = COALESCE(EXCLUDED.os, nodes.os),
+        cpu_model     = COALESCE(EXCLUDED.cpu_model, nodes.cpu_model),
+        cpu_cores     = COALESCE(EXCLUDED.cpu_cores, nodes.cpu_cores),
+        memory_gb     = COALESCE(EXCLUDED.memory_gb, nodes.memory_gb),
+        storage_gb    = COALESCE(EXCLUDED.storage_gb, nodes.storage_gb),
+        drives        = COALESCE(EXCLUDED.drives, nodes.drives),
+        gpu_model     = COALESCE(EXCLUDED.gpu_model, nodes.gpu_model),
+        version       = COALESCE(EXCLUDED.version, nodes.version)
+    RETURNING id, hostname, ip_address, mac_address, os,
+        cpu_model, cpu_cores, memory_gb, storage_gb,
+        drives, gpu_model, version,
+        EXISTS (SELECT 1 FROM prev) AS existed,
+        (SELECT hostname FROM prev) AS old_hostname,
+        (SELECT ip_address FROM prev) AS old_ip_address,
+        (SELECT mac_address FROM prev) AS old_mac_address,
+        (SELECT os FROM prev) AS old_os,
+        (SELECT cpu_model FROM prev) AS old_cpu_model,
+        (SELECT cpu_cores FROM prev) AS old_cpu_cores,
+        (SELECT memory_gb FROM prev) AS old_memory_gb,
+        (SELECT storage_gb FROM prev) AS old_storage_gb,
+        (SELECT drives FROM prev) AS old_drives,
+        (SELECT gpu_model FROM prev) AS old_gpu_model,
+        (SELECT version FROM prev) AS old_version
+"""
+
+REGISTER_INSERT_SQL = """
+    INSERT INTO nodes (
+        hostname, ip_address, mac_address, os,
+        cpu_model, cpu_cores, memory_gb, storage_gb, drives,
+        gpu_model, version, location, owner, notes,
+        status, last_heartbeat, last_checked
+    )
+    VALUES (
+        $1, $2, $3, $4,
+        $5, $6, $7, $8, $9,
+        $10, $11, '', '', '',
+        'offline', NULL, NULL
+    )
+    RETURNING id, hostname
+"""
+
+# lock + read current status and update in one round-trip;
+# the update is skipped when the node is already offline
+LOGOFF_SQL = """
+    WITH prev AS (
+        SELECT id, status
+        FROM nodes
+        WHERE id = $1
+        FOR UPDATE
+    ),
+    upd AS (
+        UPDATE nodes
+        SET status       = 'offline',
+            last_checked = now()
+        FROM prev
+        WHERE nodes.id = prev.id
+          AND prev.status IS DISTINCT FROM 'offline'
+    )
+    SELECT status
+    FROM prev
+"""
+
+# metadata only; the (possibly large, TOASTed) code column is read by
+# PAYLOAD_CODE_SQL only when the latest version/hash actually changed
+LATEST_PAYLOAD_SQL = """
+    SELECT version, signature, hash
+    FROM payloads
+    ORDER BY version DESC
+    LIMIT 1
+"""
+
+PAYLOAD_CODE_SQL = """
+    SELECT code
+    FROM payloads
+    WHERE version = $1
+"""
+
+# applied by _ensure_schema outside a transaction, only while the trigger is
+# missing (CREATE TRIGGER locks payloads against writes); must be idempotent
+SCHEMA_SQL = [
+    """
+    CREATE OR REPLACE FUNCTION notify_payloads_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('payloads_changed', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER payloads_changed
+    AFTER INSERT OR UPDATE OR DELETE ON payloads
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_payloads_changed()
+    """,
+]
+
+# built by _ensure_schema, which also rebuilds any INVALID leftover of an
+# interrupted CONCURRENTLY build (IF NOT EXISTS alone would skip it forever)
+SCHEMA_INDEXES = {
+    # offline sweep: only not-yet-offline rows, ordered by last_heartbeat.
+    # Trade-off: indexing last_heartbeat makes every heartbeat UPDATE non-HOT
+    # (new entries in every index on nodes), which gives back part of the WAL
+    # saved by batching/skipping heartbeats; worth it only while nodes is
+    # large enough that the sweep's seq-scan costs more than that.
+    "nodes_online_stale_idx": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS nodes_online_stale_idx
+    ON nodes (last_heartbeat)
+    WHERE status <> 'offline'
+    """,
+    # LATEST_PAYLOAD_SQL: ORDER BY version DESC LIMIT 1
+    "payloads_version_desc_idx": """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS payloads_version_desc_idx
+    ON payloads (version DESC)
+    """,
+}
+
+TRIGGER_EXISTS_SQL = """
+    SELECT EXISTS (
+        SELECT 1
+        FROM pg_trigger
+        WHERE tgname = 'payloads_changed'
+          AND tgrelid = to_regclass('payloads')
+    )
+"""
+
+INDEX_VALID_SQL = """
+    SELECT indisvalid
+    FROM pg_index
+    WHERE indexrelid = to_regclass($1)
+"""
+
+# statements prepared on every new pool connection, run through
+# conn.fetch_stmt(name, ...) and friends (see AppConnection); none of them
+# uses RETURNING * / SELECT *, so adding a column does not change their
+# result types
+HOT_SQL = {
+    "heartbeat": HEARTBEAT_BATCH_SQL,
+    "offline_sweep": OFFLINE_SWEEP_SQL,
+    "offline_mark": OFFLINE_MARK_SQL,
+    "register_upsert": REGISTER_UPSERT_SQL,
+    "register_insert": REGISTER_INSERT_SQL,
+    "logoff": LOGOFF_SQL,
+    "latest_payload": LATEST_PAYLOAD_SQL,
+    "payload_code": PAYLOAD_CODE_SQL,
+    "log_change": LOG_CHANGE_SQL,
+    "log_changes": LOG_CHANGES_SQL,
+}
+
 
 # ---------------------------------------------------
 # Database connection
 # ---------------------------------------------------
+class AppConnection(asyncpg.Connection):
+    """Pool connection carrying its prepared hot statements."""
+    __slots__ = ("stmts",)
+
+    async def _call_stmt(self, name, method, args):
+        # explicitly prepared statements are not re-prepared by asyncpg after
+        # a schema change (unlike its implicit cache), so do it here once
+        try:
+            return await getattr(self.stmts[name], method)(*args)
+        except (asyncpg.exceptions.InvalidCachedStatementError,
+                asyncpg.exceptions.OutdatedSchemaCacheError):
+            self.stmts[name] = await self.prepare(HOT_SQL[name])
+            return await getattr(self.stmts[name], method)(*args)
+
+    async def fetch_stmt(self, name, *args):
+        return await self._call_stmt(name, "fetch", args)
+
+    async def fetchrow_stmt(self, name, *args):
+        return await self._call_stmt(name, "fetchrow", args)
+
+    async def fetchval_stmt(self, name, *args):
+        return await self._call_stmt(name, "fetchval", args)
+
+
+async def _init_connection(conn):
+    """Prepare every hot statement once per new pool connection."""
+    # binary jsonb is a version byte followed by the JSON text; the codec
+    # has to be in place before prepare() so statements pick it up
+    await conn.set_type_codec(
+        "jsonb",
+        encoder=lambda v: b"\x01" + orjson.dumps(v),
+        decoder=lambda v: orjson.loads(v[1:]),
+        schema="pg_catalog",
+        format="binary",
+    )
+    conn.stmts = {name: await conn.prepare(sql) for name, sql in HOT_SQL.items()}
+
+
+async def _ensure_schema(conn):
+    """Apply SCHEMA_SQL and SCHEMA_INDEXES, rebuilding INVALID index leftovers."""
+    # one worker at a time, so nobody drops an index another is still building
+    # and concurrent CREATE OR REPLACE calls don't collide. Never wait in
+    # pg_advisory_lock: the waiter's snapshot would make the holder's
+    # CONCURRENTLY build wait on it in turn (deadlock); whoever got the lock
+    # does everything, the others just skip
+    if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('service-api schema'))"):
+        return
+    try:
+        if not await conn.fetchval(TRIGGER_EXISTS_SQL):
+            for sql in SCHEMA_SQL:
+                await conn.execute(sql)
+
+        for name, sql in SCHEMA_INDEXES.items():
+            valid = await conn.fetchval(INDEX_VALID_SQL, name)
+            if valid is True:
+                continue
+            if valid is False:
+                print(f"rebuilding invalid index {name}")
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            await conn.execute(sql)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock(hashtext('service-api schema'))")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Starting up...")
-    app.state.db_pool = await asyncpg.create_pool(DB_URL)
+
+    # schema goes first, before any pool connection prepares statements
+    schema_conn = await asyncpg.connect(DB_URL_DIRECT)
+    try:
+        await _ensure_schema(schema_conn)
+    except Exception as e:
+        print("schema error:", e)
+    finally:
+        await schema_conn.close()
+
+    app.state.db_pool = await asyncpg.create_pool(
+        DB_URL,
+        connection_class=AppConnection,
+        init=_init_connection,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        max_queries=50000,
+        max_inactive_connection_lifetime=300,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE,
+    )
 
     # -----------------------------
     # BACKGROUND OFFLINE SCANNER
     # -----------------------------
+    # heartbeat schedules each node once on app.state.expiry_heap at
+    # last-seen + OFFLINE_AFTER; the scanner sleeps until the earliest
+    # deadline, reschedules nodes that pinged since, and asks the DB to
+    # mark the rest offline. A slow full sweep catches nodes that only
+    # ever pinged another worker (or a previous process).
     async def offline_scanner():
+        heap = app.state.expiry_heap
+        scheduled = app.state.expiry_scheduled
+        online_since = app.state.online_since
+        next_sweep = 0.0
+
         while True:
+            now = time.monotonic()
             try:
-                async with app.state.db_pool.acquire() as conn:
-                    rows = await conn.fetch("""
-                                            SELECT id, status
-                                            FROM nodes
-                                            WHERE last_heartbeat < (now() - interval '300 seconds')
-                                              AND status != 'offline'
-                                            """)
-
-                    for r in rows:
-                        node_id = r["id"]
-                        old_status = r["status"]
-
-                        # Perform update
-                        await conn.execute("""
-                                           UPDATE nodes
-                                           SET status='offline',
-                                               last_checked=now()
-                                           WHERE id = $1
-                                           """, node_id)
-
-                        # Log transition
-                        await log_field_change(conn, node_id, "status", old_status, "offline")
+                if now >= next_sweep:
+                    next_sweep = now + OFFLINE_SWEEP_INTERVAL
+                    async with app.state.db_pool.acquire() as conn:
+                        await conn.fetch_stmt("offline_sweep", OFFLINE_AFTER)
+
+                expired = []
+                while heap and heap[0][0] <= now:
+                    _, node_id = heapq.heappop(heap)
+                    seen = online_since.get(node_id)
+                    if seen is not None and seen + OFFLINE_AFTER > now:
+                        heapq.heappush(heap, (seen + OFFLINE_AFTER, node_id))
+                    else:
+                        expired.append(node_id)
+
+                if expired:
+                    try:
+                        async with app.state.db_pool.acquire() as conn:
+                            rows = await conn.fetch_stmt("offline_mark", expired, OFFLINE_AFTER)
+                    except Exception:
+                        # keep them scheduled and retry shortly
+                        due = time.monotonic() + OFFLINE_RETRY_INTERVAL
+                        for node_id in expired:
+                            heapq.heappush(heap, (due, node_id))
+                        raise
+
+                    # not stale yet in the DB: recheck at its own deadline
+                    remaining = {str(r["id"]): r["remaining"] for r in rows}
+                    for node_id in expired:
+                        if node_id in remaining:
+                            due = time.monotonic() + max(remaining[node_id], 1.0)
+                            heapq.heappush(heap, (due, node_id))
+                        else:
+                            scheduled.discard(node_id)
 
             except Exception as e:
                 print("offline_scanner error:", e)
 
-            await asyncio.sleep(15)
+            # new entries are always due after the current head, so
+            # nothing needs to wake this sleep early
+            wake = min(heap[0][0], next_sweep) if heap else next_sweep
+            await asyncio.sleep(max(wake - time.monotonic(), 0))
+
+    # -----------------------------
+    # HEARTBEAT BATCH FLUSHER
+    # -----------------------------
+    async def write_heartbeats(ids):
+        """Mark ids online in one statement; return the ids that exist."""
+        async with app.state.db_pool.acquire() as conn:
+            rows = await conn.fetch_stmt("heartbeat", ids)
+
+        # ids come back in nodes.id's type (e.g. UUID); callers hold strings
+        return {str(r["id"]) for r in rows}
+
+    async def heartbeat_flusher():
+        queue = app.state.hb_queue
+        while True:
+            # block for the first heartbeat, then give others a moment to pile up
+            batch = [await queue.get()]
+            await asyncio.sleep(HB_BATCH_WINDOW)
+            while len(batch) < HB_BATCH_MAX and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                found = await write_heartbeats(list({node_id for node_id, _ in batch}))
+                for node_id, ack in batch:
+                    if not ack.done():
+                        ack.set_result(node_id in found)
+
+            except Exception as e:
+                print("heartbeat_flusher error:", e)
+                for _, ack in batch:
+                    if not ack.done():
+                        ack.set_exception(e)
 
-    # start task
+    # -----------------------------
+    # SKIPPED HEARTBEAT SYNC
+    # -----------------------------
+    # heartbeats from recently seen nodes skip the DB; this writes them out
+    # every HB_FLUSH_INTERVAL so last_heartbeat never falls behind the
+    # offline cutoff (it may lead the real ping by up to that interval)
+    async def heartbeat_syncer():
+        while True:
+            await asyncio.sleep(HB_FLUSH_INTERVAL)
+
+            pending, app.state.hb_pending = app.state.hb_pending, set()
+
+            # the offline scanner reads online_since, so keep entries for
+            # as long as a node can still be considered online
+            cutoff = time.monotonic() - OFFLINE_AFTER
+            online_since = app.state.online_since
+            for node_id in [k for k, seen in online_since.items() if seen < cutoff]:
+                del online_since[node_id]
+
+            if not pending:
+                continue
+            try:
+                found = await write_heartbeats(list(pending))
+                for node_id in pending - found:
+                    online_since.pop(node_id, None)
+            except Exception as e:
+                print("heartbeat_syncer error:", e)
+                app.state.hb_pending |= pending
+
+    # -----------------------------
+    # LATEST PAYLOAD CACHE
+    # -----------------------------
+    # /update is served from app.state.latest_payload; a NOTIFY from the
+    # payloads trigger wakes this up, and the timeout covers missed
+    # notifications (e.g. while the listener is reconnecting)
+    payload_changed = asyncio.Event()
+
+    async def payload_listener():
+        delay = 1
+        while True:
+            conn = None
+            lost = asyncio.Event()
+            try:
+                conn = await asyncpg.connect(DB_URL_DIRECT)
+                conn.add_termination_listener(lambda c, lost=lost: lost.set())
+                await conn.add_listener(PAYLOAD_CHANNEL, lambda *args: payload_changed.set())
+                delay = 1
+
+                # pick up anything published while nobody was listening
+                payload_changed.set()
+                await lost.wait()
+                print("payload_listener: connection lost, reconnecting")
+            except Exception as e:
+                print("payload_listener error:", e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, PAYLOAD_REFRESH_INTERVAL)
+
+    async def refresh_latest_payload():
+        async with app.state.db_pool.acquire() as conn:
+            meta = await conn.fetchrow_stmt("latest_payload")
+            if meta is None:
+                app.state.latest_payload = None
+                return
+
+            cached = app.state.latest_payload
+            if cached and (cached["version"], cached["hash"]) == (meta["version"], meta["hash"]):
+                if cached["signature"] == meta["signature"]:
+                    return
+                code = cached["code"]
+            else:
+                code = await conn.fetchval_stmt("payload_code", meta["version"])
+
+                # checked once per new payload, never per request; a payload
+                # whose code doesn't match its hash is never published, and
+                # the previous one keeps being served
+                if code is not None and await asyncio.to_thread(compute_hash, code) != meta["hash"]:
+                    print(f"payload {meta['version']}: stored hash does not match code, not serving it")
+                    return
+
+        # the response body is built and gzipped once per payload, not per request
+        body = orjson.dumps({
+            "version": str(meta["version"]),
+            "signature": meta["signature"],
+            "hash": meta["hash"],
+            "code": code,
+        })
+        body_gz = await asyncio.to_thread(gzip.compress, body)
+        app.state.latest_payload = {
+            **meta,
+            "code": code,
+            "body": body,
+            "body_gz": body_gz,
+        }
+
+    async def payload_watcher():
+        while True:
+            try:
+                await asyncio.wait_for(payload_changed.wait(), PAYLOAD_REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            payload_changed.clear()
+
+            try:
+                await refresh_latest_payload()
+            except Exception as e:
+                print("payload_watcher error:", e)
+
+    app.state.latest_payload = None
+    await refresh_latest_payload()
+
+    # start tasks
+    app.state.hb_queue = asyncio.Queue()
+    app.state.online_since = {}
+    app.state.hb_pending = set()
+    app.state.expiry_heap = []
+    app.state.expiry_scheduled = set()
     app.state.scanner_task = asyncio.create_task(offline_scanner())
+    app.state.hb_flusher_task = asyncio.create_task(heartbeat_flusher())
+    app.state.hb_syncer_task = asyncio.create_task(heartbeat_syncer())
+    app.state.payload_task = asyncio.create_task(payload_watcher())
+    app.state.listener_task = asyncio.create_task(payload_listener())
 
     yield
 
     print("Shutting down...")
     app.state.scanner_task.cancel()
+    app.state.hb_flusher_task.cancel()
+    app.state.hb_syncer_task.cancel()
+    app.state.payload_task.cancel()
+    app.state.listener_task.cancel()
+    await asyncio.gather(app.state.listener_task, return_exceptions=True)  # closes its connection
     await app.state.db_pool.close()
 
 
 
 app = FastAPI(
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url=None,
     redoc_url=None,
     openapi_url=None
@@ -90,6 +697,8 @@ app = FastAPI(
 # Models
 # ---------------------------------------------------
 class NodeSpecs(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True, str_max_length=256)
+
     id: Optional[str] = None
     hostname: str
     ip_address: str
@@ -113,14 +722,51 @@ def compute_hash(code: str) -> str:
     return base64.b64encode(h).decode()
 
 
+def _log_value(value):
+    """Render a field value as stored in node_change_log."""
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip (q > 0, directly or via *)."""
+    gzip_q = star_q = None
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        coding = coding.strip().lower()
+        if coding in ("gzip", "x-gzip"):
+            gzip_q = q
+        elif coding == "*":
+            star_q = q
+
+    if gzip_q is not None:
+        return gzip_q > 0
+    return bool(star_q)
+
+
 async def log_field_change(conn, node_id, field, old, new):
     if old == new:
         return
-    await conn.execute("""
-                       INSERT INTO node_change_log (node_id, field_name, old_value, new_value, changed_at)
-                       VALUES ($1, $2, $3, $4, now())
-                       """, node_id, field, str(old) if old is not None else None,
-                       str(new) if new is not None else None)
+    await conn.fetch_stmt("log_change", node_id, field, _log_value(old), _log_value(new))
+
+
+async def log_field_changes(conn, node_id, changes):
+    """Write (field, old, new) tuples of one node to node_change_log at once."""
+    if not changes:
+        return
+    fields, olds, news = zip(*changes)
+    await conn.fetch_stmt("log_changes", node_id, list(fields), list(olds), list(news))
 
 
 # ---------------------------------------------------
@@ -136,34 +782,49 @@ async def ping():
     return {"ping": "pong"}
 
 
-@app.post("/heartbeat")
-async def heartbeat(request: Request, id: str):
-    pool = request.app.state.db_pool
-    async with pool.acquire() as conn:
-
-        old_row = await conn.fetchrow("""
-            SELECT status
-            FROM nodes
-            WHERE id=$1
-        """, id)
-
-        if not old_row:
+async def heartbeat(request: Request):
+    # plain Starlette route: the busiest endpoint needs one query param,
+    # so it skips FastAPI's dependency/validation layer entirely
+    id = request.query_params.get("id")
+    if id is None:
+        raise HTTPException(status_code=422, detail="Missing id query parameter")
+
+    state = request.app.state
+
+    # a node seen moments ago is known to exist and be online; defer its
+    # write to the heartbeat syncer
+    now = time.monotonic()
+    prev = state.online_since.get(id)
+    if prev is not None and now - prev < HB_FLUSH_INTERVAL:
+        state.online_since[id] = now
+        state.hb_pending.add(id)
+    else:
+        # queued for the batch flusher; the ack says whether the node exists.
+        # online_since is only written once the DB confirmed the node
+        ack = asyncio.get_running_loop().create_future()
+        state.hb_queue.put_nowait((id, ack))
+
+        try:
+            found = await ack
+        except Exception:
+            state.online_since.pop(id, None)
+            raise
+
+        if not found:
+            state.online_since.pop(id, None)
             raise HTTPException(status_code=404, detail="Node ID not found")
 
-        old_status = old_row["status"]
+        state.online_since[id] = now
 
-        await conn.execute("""
-            UPDATE nodes
-            SET last_heartbeat = now(),
-                status = 'online'
-            WHERE id = $1
-        """, id)
+    # one heap entry per node; the scanner pushes it forward as needed
+    if id not in state.expiry_scheduled:
+        state.expiry_scheduled.add(id)
+        heapq.heappush(state.expiry_heap, (now + OFFLINE_AFTER, id))
 
-        if old_status != "online":
-            await log_field_change(conn, id, "status", old_status, "online")
+    return Response(content=_HB_OK_PREFIX + orjson.dumps(id) + b"}", media_type="application/json")
 
-    return {"status": "updated", "id": id}
 
+app.add_route("/heartbeat", heartbeat, methods=["POST"])
 
 
 @app.post("/register")
@@ -171,42 +832,12 @@ async def register(specs: NodeSpecs, request: Request):
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
 
-        old_row = None
-        if getattr(specs, "id", None):
-            old_row = await conn.fetchrow("SELECT * FROM nodes WHERE id=$1", specs.id)
-
-        if getattr(specs, "id", None):
-            query = """
-                INSERT INTO nodes (
-                    id, hostname, ip_address, mac_address, os,
-                    cpu_model, cpu_cores, memory_gb, storage_gb, drives,
-                    gpu_model, version, location, owner, notes,
-                    status, last_heartbeat, last_checked
-                )
-                VALUES (
-                    $1, $2, $3, $4, $5,
-                    $6, $7, $8, $9, $10,
-                    $11, $12, '', '', '',
-                    'offline', NULL, NULL
-                )
-                ON CONFLICT (id)
-                DO UPDATE SET
-                    hostname      = COALESCE(EXCLUDED.hostname, nodes.hostname),
-                    ip_address    = COALESCE(EXCLUDED.ip_address, nodes.ip_address),
-                    mac_address   = COALESCE(EXCLUDED.mac_address, nodes.mac_address),
-                    os            = COALESCE(EXCLUDED.os, nodes.os),
-                    cpu_model     = COALESCE(EXCLUDED.cpu_model, nodes.cpu_model),
-                    cpu_cores     = COALESCE(EXCLUDED.cpu_cores, nodes.cpu_cores),
-                    memory_gb     = COALESCE(EXCLUDED.memory_gb, nodes.memory_gb),
-                    storage_gb    = COALESCE(EXCLUDED.storage_gb, nodes.storage_gb),
-                    drives        = COALESCE(EXCLUDED.drives, nodes.drives),
-                    gpu_model     = COALESCE(EXCLUDED.gpu_model, nodes.gpu_model),
-                    version       = COALESCE(EXCLUDED.version, nodes.version)
-                RETURNING *
-            """
-            row = await conn.fetchrow(
-                query,
-                specs.id,
+        node_id = specs.id
+        existed = False
+        if node_id:
+            row = await conn.fetchrow_stmt(
+                "register_upsert",
+                node_id,
                 specs.hostname,
                 specs.ip_address,
                 specs.mac_address,
@@ -215,29 +846,16 @@ async def register(specs: NodeSpecs, request: Request):
                 specs.cpu_cores,
                 specs.memory_gb,
                 specs.storage_gb,
-                json.dumps(specs.drives) if specs.drives else None,
+                specs.drives or None,
                 specs.gpu_model,
                 specs.version
             )
 
+            existed = row["existed"]
+
         else:
-            query = """
-                INSERT INTO nodes (
-                    hostname, ip_address, mac_address, os,
-                    cpu_model, cpu_cores, memory_gb, storage_gb, drives,
-                    gpu_model, version, location, owner, notes,
-                    status, last_heartbeat, last_checked
-                )
-                VALUES (
-                    $1, $2, $3, $4,
-                    $5, $6, $7, $8, $9,
-                    $10, $11, '', '', '',
-                    'offline', NULL, NULL
-                )
-                RETURNING *
-            """
-            row = await conn.fetchrow(
-                query,
+            row = await conn.fetchrow_stmt(
+                "register_insert",
                 specs.hostname,
                 specs.ip_address,
                 specs.mac_address,
@@ -246,22 +864,21 @@ async def register(specs: NodeSpecs, request: Request):
                 specs.cpu_cores,
                 specs.memory_gb,
                 specs.storage_gb,
-                json.dumps(specs.drives) if specs.drives else None,
+                specs.drives or None,
                 specs.gpu_model,
                 specs.version
             )
 
         # no status logging
-        if old_row:
-            fields = [
-                "hostname", "ip_address", "mac_address", "os",
-                "cpu_model", "cpu_cores", "memory_gb", "storage_gb",
-                "drives", "gpu_model", "version"
-            ]
-            for f in fields:
-                old = old_row[f]
+        if existed:
+            changes = []
+            for f in NODE_SPEC_FIELDS:
+                old = row["old_" + f]
                 new = row[f]
-                await log_field_change(conn, row["id"], f, old, new)
+                if old != new:
+                    changes.append((f, _log_value(old), _log_value(new)))
+
+            await log_field_changes(conn, row["id"], changes)
 
     return {"status": "registered", "hostname": row["hostname"], "id": row["id"]}
 
@@ -269,30 +886,21 @@ async def register(specs: NodeSpecs, request: Request):
 
 @app.post("/logoff")
 async def logoff(id: str, request: Request):
+    # forget the node so its next heartbeat goes straight to the DB
+    request.app.state.online_since.pop(id, None)
+    request.app.state.hb_pending.discard(id)
+
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
 
-        # fetch current status
-        old = await conn.fetchrow("""
-                                  SELECT status
-                                  FROM nodes
-                                  WHERE id = $1
-                                  """, id)
+        old = await conn.fetchrow_stmt("logoff", id)
 
         if not old:
             raise HTTPException(status_code=404, detail="Node ID not found")
 
         old_status = old["status"]
 
-        # only update + log if status actually changes
         if old_status != "offline":
-            await conn.execute("""
-                               UPDATE nodes
-                               SET status       = 'offline',
-                                   last_checked = now()
-                               WHERE id = $1
-                               """, id)
-
             # log only real transitions
             await log_field_change(
                 conn, id,
@@ -313,45 +921,49 @@ async def get_update(request: Request, hash: Optional[str] = Query(None)):
     Return signed payload only if there is a newer version.
     Request param: ?hash=<local_base64_hash>
     """
-    pool = request.app.state.db_pool
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """SELECT version, code, signature, hash
-               FROM payloads
-               ORDER BY version DESC
-               LIMIT 1"""
+    row = request.app.state.latest_payload
+    if not row:
+        raise HTTPException(status_code=503, detail="No payloads available yet")
+
+    if hash and hash == row["hash"]:
+        # client already has latest
+        return {}
+
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        return Response(
+            content=row["body_gz"],
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
         )
-        if not row:
-            raise HTTPException(status_code=503, detail="No payloads available yet")
-
-        version = row["version"]
-        code = row["code"]
-        signature = row["signature"]
-        stored_hash = row["hash"]
-
-        if hash and hash == stored_hash:
-            # client already has latest
-            return {}
-
-        return JSONResponse({
-            "version": str(version),
-            "signature": signature,
-            "hash": stored_hash,
-            "code": code,
-        })
+    return Response(content=row["body"], media_type="application/json", headers={"Vary": "Accept-Encoding"})
 
 
 @app.get("/public_key")
-async def get_public_key():
+async def get_public_key(request: Request):
     """Serve the public RSA key (hard-coded for integrity)."""
-    return JSONResponse({
-        "public_key": """-----BEGIN PUBLIC KEY-----
-MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA8sPfrF4g6PreceYsXlFm
-8EfXnbrVw357XIONBw944ltP708tnM4bRUBHlVoKdHigmoTjWgiz3IsKozOWsydp
-qcQWB/ooQKqi4/Quvy1H5f2MFdlLZnyFPZOsW4Cq6X7ngtyxM0+WpDkU4EMBgwuL
-Zwvqx1UYeh0prRqEsR4x766NjYDklaSf6Xbj4GQRrYkWRi3Up47cRD3GIH33AhbJ
-AwlxqefLHeicMAT5s+povQGjnLizKqNgLFjIzaMfKbAifQ6jfvq/pG7WWcUSkZ4c
-p1IdGVbcH50OtxwKervSH1QDhF4Es2O9gHK/+admpSTko7fK7wHc5fk/anH2Hzzl
-nwIDAQAB
------END PUBLIC KEY-----"""
-    })
+    if request.headers.get("if-none-match") == _PK_ETAG:
+        return Response(status_code=304, headers=_PK_HEADERS)
+    return Response(content=_PK_BYTES, media_type="application/json", headers=_PK_HEADERS)
+
+
+# ---------------------------------------------------
+# Entrypoint
+# ---------------------------------------------------
+# Same as:
+#   uvicorn api:app --loop uvloop --http httptools --workers $WEB_CONCURRENCY \
+#       --backlog 4096 --limit-concurrency 10000 --timeout-keep-alive 75
+# Keep-alive outlasts the node ping interval so heartbeats reuse connections.
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "api:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8000)),
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # no uvloop on Windows
+        http="httptools",
+        backlog=4096,
+        limit_concurrency=10000,
+        timeout_keep_alive=75,
+    )